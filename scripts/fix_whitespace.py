@@ -4,250 +4,424 @@ Comprehensive whitespace fixer for Klipper code standards.
 This script fixes common whitespace issues in Python and C files.
 """
 
+import functools
+import io
+import itertools
 import os
-import re
+import shutil
 import sys
+import tempfile
+import tokenize
+import warnings
 import argparse
 
 
+# Logical operators to break on, in order of preference
+_OPERATORS = (' and ', ' or ', ' if ', ' else ')
+
+# All operators a line may be broken at (string concatenation first)
+_BREAK_OPS = (' + ',) + _OPERATORS
+
+# Token types that open and close an f-string (Python 3.12 and later)
+_FSTRING_START = getattr(tokenize, 'FSTRING_START', None)
+_FSTRING_END = getattr(tokenize, 'FSTRING_END', None)
+
+_OPEN_BRACKETS = frozenset('([{')
+_CLOSE_BRACKETS = frozenset(')]}')
+
+# Results of fix_file_whitespace()
+UNCHANGED = 'unchanged'
+FIXED = 'fixed'
+FAILED = 'failed'
+
+
+class LineInfo:
+    """A long line and its scan results, shared by the break strategies.
+
+    Scans are computed on first use and then reused by every strategy.
+    """
+    def __init__(self, line, indent_str):
+        self.line = line
+        self.indent_str = indent_str
+        self._op_tokens = None
+        self._op_positions = None
+
+    def get_op_tokens(self):
+        """List of (string, column) for the line's OP and NAME tokens.
+
+        Tokens in strings, f-strings and the trailing comment are left
+        out.
+        """
+        if self._op_tokens is None:
+            self._op_tokens = self._tokenize_ops()
+        return self._op_tokens
+
+    def get_op_positions(self):
+        """Map each operator in _BREAK_OPS to its positions in the code."""
+        if self._op_positions is None:
+            self._op_positions = self._scan_ops()
+        return self._op_positions
+
+    def _tokenize_ops(self):
+        op_tokens = []
+        fstring_depth = 0
+        readline = io.StringIO(self.line).readline
+        try:
+            for tok in tokenize.generate_tokens(readline):
+                if tok.type == tokenize.COMMENT:
+                    break
+                if tok.type == _FSTRING_START:
+                    fstring_depth += 1
+                elif tok.type == _FSTRING_END:
+                    fstring_depth -= 1
+                elif (tok.type in (tokenize.OP, tokenize.NAME)
+                      and not fstring_depth):
+                    op_tokens.append((tok.string, tok.start[1]))
+        except (tokenize.TokenError, SyntaxError):
+            # Keep the tokens found before the line stopped parsing
+            # (eg, a statement continued on the next line)
+            pass
+        return op_tokens
+
+    def _scan_ops(self):
+        positions = {op: [] for op in _BREAK_OPS}
+        for string, col in self.get_op_tokens():
+            # Only break where the operator has code before it and a
+            # space on each side
+            op = ' ' + string + ' '
+            if (op in positions and col > len(self.indent_str)
+                    and self.line.startswith(op, col - 1)):
+                positions[op].append(col - 1)
+        return positions
+
+    def is_bracketed(self, pos):
+        """Check if pos is inside brackets opened earlier on the line.
+
+        Only there can the line be broken without a backslash.
+        """
+        depth = 0
+        for string, col in self.get_op_tokens():
+            if col >= pos:
+                break
+            if string in _OPEN_BRACKETS:
+                depth += 1
+            elif string in _CLOSE_BRACKETS:
+                depth -= 1
+        return depth > 0
+
+    def split_brackets(self, open_char):
+        """Split the first open_char bracket pair into top-level items.
+
+        Returns (open_pos, close_pos, items), or None if the line has no
+        complete pair.
+        """
+        open_pos = None
+        for string, col in self.get_op_tokens():
+            if open_pos is None:
+                if string == open_char:
+                    open_pos = item_start = col
+                    depth = 1
+                    items = []
+            elif string in _OPEN_BRACKETS:
+                depth += 1
+            elif string in _CLOSE_BRACKETS:
+                depth -= 1
+                if not depth:
+                    items.append(self.line[item_start + 1:col].strip())
+                    return open_pos, col, items
+            elif string == ',' and depth == 1:
+                items.append(self.line[item_start + 1:col].strip())
+                item_start = col
+        return None
+
+
 def fix_python_line(line, line_num):
-    """Fix a single Python line to meet Klipper standards."""
-    original_line = line
-    
-    # Remove trailing whitespace
-    line = line.rstrip()
-    
-    # Skip certain types of lines that are hard to break
-    if (line.strip().startswith('#') or 
-        line.strip().startswith('"""') or 
-        line.strip().startswith("'''") or
-        '"""' in line or
-        "'''" in line):
-        return line
-    
-    # If line is not too long, return as-is
-    if len(line) <= 80:
+    """Fix a single over-long Python line to meet Klipper standards.
+
+    The line must already have its trailing whitespace removed.
+    """
+    # Skip comments and lines that touch a docstring
+    stripped = line.lstrip()
+    if (stripped.startswith('#') or '"""' in stripped
+            or "'''" in stripped):
         return line
     
     # Get indentation
-    indent = len(line) - len(line.lstrip())
-    indent_str = line[:indent]
-    
-    # Try various strategies to break long lines
-    fixed_line = try_break_string_concat(line, indent_str)
-    if fixed_line != line:
-        return fixed_line
+    info = LineInfo(line, line[:len(line) - len(stripped)])
     
-    fixed_line = try_break_function_args(line, indent_str)
-    if fixed_line != line:
-        return fixed_line
+    # Try various strategies to break long lines.  Candidates are
+    # generated lazily, so later strategies only run if no earlier
+    # candidate fits within 80 columns.
+    candidates = itertools.chain.from_iterable(
+        strategy(info) for strategy in (try_break_string_concat,
+                                        try_break_function_args,
+                                        try_break_operators,
+                                        try_break_list_dict))
+    best_line, best_len = line, len(line)
+    for fixed_line, max_line_len in candidates:
+        if max_line_len <= 80:
+            return fixed_line
+        if max_line_len < best_len:
+            best_line, best_len = fixed_line, max_line_len
     
-    fixed_line = try_break_operators(line, indent_str)
-    if fixed_line != line:
-        return fixed_line
-    
-    fixed_line = try_break_list_dict(line, indent_str)
-    if fixed_line != line:
-        return fixed_line
-    
-    # If we can't break it nicely, return original
-    return line
+    # Otherwise use the candidate with the shortest longest line (or
+    # the original if nothing helped)
+    return best_line
 
 
-def try_break_string_concat(line, indent_str):
-    """Try to break string concatenation."""
-    if ' + ' in line and ('"' in line or "'" in line):
-        # Look for string concatenation patterns
-        parts = line.split(' + ')
-        if len(parts) > 1:
-            # Check if we can break after a string
-            for i in range(len(parts) - 1):
-                if ('"' in parts[i] or "'" in parts[i]):
-                    left = ' + '.join(parts[:i+1])
-                    right = ' + '.join(parts[i+1:])
-                    if len(left) <= 80:
-                        return left + ' +\n' + indent_str + '    ' + right
-    return line
+def join_if_short(lines):
+    """Join lines with newlines if none is over 80 columns.
+
+    Returns (joined, max_line_len), or None as soon as a line is too
+    long.
+    """
+    parts = []
+    max_line_len = 0
+    for part in lines:
+        if len(part) > 80:
+            return None
+        max_line_len = max(max_line_len, len(part))
+        parts.append(part)
+    return '\n'.join(parts), max_line_len
+
+
+def try_break_string_concat(info):
+    """Yield (fixed_line, max_line_len) for breaking string concatenation."""
+    line = info.line
+    if '"' not in line and "'" not in line:
+        return
+
+    # Break after the first concatenated part that contains a string
+    part_start = 0
+    for pos in info.get_op_positions()[' + ']:
+        if pos > 80:
+            break
+        part = line[part_start:pos]
+        if ('"' in part or "'" in part) and info.is_bracketed(pos):
+            right = info.indent_str + '    ' + line[pos + 3:]
+            yield line[:pos] + ' +\n' + right, max(pos + 2, len(right))
+            return
+        part_start = pos + 3
 
 
-def try_break_function_args(line, indent_str):
-    """Try to break long function calls."""
+def try_break_function_args(info):
+    """Yield (fixed_line, max_line_len) for breaking function calls."""
+    line = info.line
+    indent_str = info.indent_str
     # Look for function calls with multiple arguments
     if '(' in line and ')' in line and ', ' in line:
         # Find the function call
-        paren_start = line.find('(')
-        paren_end = line.rfind(')')
+        call = info.split_brackets('(')
         
-        if paren_start != -1 and paren_end != -1:
+        if call is not None:
+            paren_start, paren_end, args = call
             before_paren = line[:paren_start + 1]
-            args_part = line[paren_start + 1:paren_end]
             after_paren = line[paren_end:]
             
-            # Split arguments
-            args = []
-            current_arg = ''
-            paren_depth = 0
-            quote_char = None
-            
-            for char in args_part:
-                if char in ['"', "'"] and quote_char is None:
-                    quote_char = char
-                elif char == quote_char:
-                    quote_char = None
-                elif char == '(' and quote_char is None:
-                    paren_depth += 1
-                elif char == ')' and quote_char is None:
-                    paren_depth -= 1
-                elif char == ',' and paren_depth == 0 and quote_char is None:
-                    args.append(current_arg.strip())
-                    current_arg = ''
-                    continue
-                
-                current_arg += char
-            
-            if current_arg.strip():
-                args.append(current_arg.strip())
+            if args and not args[-1]:
+                args.pop()
             
             # Try to break the arguments
             if len(args) > 1:
                 # Break after the opening parenthesis
-                result = before_paren + '\n'
-                for i, arg in enumerate(args):
-                    if i == 0:
-                        result += indent_str + '    ' + arg
-                    else:
-                        result += ',\n' + indent_str + '    ' + arg
-                result += after_paren
-                
-                # Check if this improves line length
-                max_line_len = max(len(l) for l in result.split('\n'))
-                if max_line_len <= 80:
-                    return result
-    
-    return line
+                item_indent = indent_str + '    '
+                result = join_if_short(itertools.chain(
+                    [before_paren],
+                    (item_indent + arg + ',' for arg in args[:-1]),
+                    [item_indent + args[-1] + after_paren]))
+                if result is not None:
+                    yield result
 
 
-def try_break_operators(line, indent_str):
-    """Try to break on logical operators."""
-    operators = [' and ', ' or ', ' if ', ' else ']
-    
-    for op in operators:
-        if op in line:
-            # Find the best place to break
-            parts = line.split(op)
-            if len(parts) > 1:
-                # Try breaking after each operator
-                for i in range(len(parts) - 1):
-                    left = op.join(parts[:i+1])
-                    right = op.join(parts[i+1:])
-                    if len(left) <= 80:
-                        continuation_indent = indent_str + '       '
-                        return left + op.strip() + '\n' + continuation_indent + right
-    
-    return line
+def try_break_operators(info):
+    """Yield (fixed_line, max_line_len) for breaking logical operators."""
+    # Break at the first occurrence of each operator (most preferred
+    # first) that leaves a short enough left-hand side.  Only breaks
+    # inside brackets are valid without a backslash.
+    line = info.line
+    for op in _OPERATORS:
+        for pos in info.get_op_positions()[op]:
+            if pos > 80:
+                break
+            if info.is_bracketed(pos):
+                left = line[:pos] + ' ' + op.strip()
+                right = info.indent_str + '       ' + line[pos + len(op):]
+                yield left + '\n' + right, max(len(left), len(right))
+                break
 
 
-def try_break_list_dict(line, indent_str):
-    """Try to break lists or dictionaries."""
+def try_break_list_dict(info):
+    """Yield (fixed_line, max_line_len) for breaking list literals."""
+    line = info.line
+    indent_str = info.indent_str
     if '[' in line and ']' in line and ', ' in line:
         # Handle list literals
-        bracket_start = line.find('[')
-        bracket_end = line.rfind(']')
+        brackets = info.split_brackets('[')
         
-        if bracket_start != -1 and bracket_end != -1:
+        if brackets is not None:
+            bracket_start, bracket_end, items = brackets
             before_bracket = line[:bracket_start + 1]
-            list_content = line[bracket_start + 1:bracket_end]
             after_bracket = line[bracket_end:]
             
-            # Split list items
-            items = [item.strip() for item in list_content.split(',')]
-            
+            items = [item for item in items if item]  # Skip empty items
             if len(items) > 1:
-                result = before_bracket + '\n'
-                for i, item in enumerate(items):
-                    if item:  # Skip empty items
-                        if i == 0:
-                            result += indent_str + '    ' + item
-                        else:
-                            result += ',\n' + indent_str + '    ' + item
-                result += '\n' + indent_str + after_bracket
-                
-                # Check if this improves line length
-                max_line_len = max(len(l) for l in result.split('\n'))
-                if max_line_len <= 80:
-                    return result
-    
-    return line
+                item_indent = indent_str + '    '
+                result = join_if_short(itertools.chain(
+                    [before_bracket],
+                    (item_indent + item + ',' for item in items[:-1]),
+                    [item_indent + items[-1], indent_str + after_bracket]))
+                if result is not None:
+                    yield result
 
 
-def fix_c_line(line, line_num):
-    """Fix a single C line to meet Klipper standards."""
-    # Remove trailing whitespace
+def fix_line(line, line_num, is_python):
+    """Fix a raw line, returning bytes without the line ending.
+
+    Python lines that get broken up contain embedded newlines.
+    """
+    # Remove newline and trailing whitespace
     line = line.rstrip()
-    
-    # Skip preprocessor directives and comments
-    if (line.strip().startswith('#') or 
-        line.strip().startswith('//') or
-        line.strip().startswith('/*')):
-        return line
-    
-    # For C files, we're more conservative about line breaking
-    # Just remove trailing whitespace for now
+
+    # Refuse to modify anything that isn't UTF-8 text (eg, binary
+    # files)
+    nul_pos = line.find(b'\0')
+    if nul_pos >= 0:
+        raise UnicodeDecodeError('utf-8', line, nul_pos, nul_pos + 1,
+                                 'NUL byte in text file')
+    text = line.decode('utf-8')
+
+    # Only long Python lines need further fixes
+    if is_python and len(text) > 80:
+        return fix_python_line(text, line_num).encode('utf-8')
     return line
 
 
-def fix_file_whitespace(file_path):
-    """Fix whitespace issues in a single file."""
+def is_clean(lines, is_python):
+    """Check whether fixing the given raw lines would change nothing."""
+    fixed_line = None
+    for line_num, line in enumerate(lines, 1):
+        fixed_line = fix_line(line, line_num, is_python)
+        if fixed_line + b'\n' != line:
+            return False
+    # A trailing empty line would be dropped
+    return fixed_line != b''
+
+
+def fix_lines(lines, is_python):
+    """Yield the fixed lines of a file as bytes, without line endings."""
+    for line_num, line in enumerate(lines, 1):
+        fixed_line = fix_line(line, line_num, is_python)
+        if b'\n' in fixed_line:
+            yield from fixed_line.split(b'\n')
+        else:
+            yield fixed_line
+
+
+def write_lines(f, lines):
+    """Write byte lines to f, dropping trailing empty lines."""
+    # Hold back empty lines until a non-empty line shows they are not
+    # at the end of the file
+    pending_blank = 0
+    for line in lines:
+        if not line:
+            pending_blank += 1
+            continue
+        if pending_blank:
+            f.write(b'\n' * pending_blank)
+            pending_blank = 0
+        f.write(line)
+        f.write(b'\n')
+
+
+def compiles(file_path):
+    """Check whether a Python source file compiles."""
+    with open(file_path, 'rb') as f:
+        source = f.read()
+    with warnings.catch_warnings():
+        # Only syntax errors matter here, not eg invalid escapes
+        warnings.simplefilter('ignore')
+        try:
+            compile(source, file_path, 'exec', dont_inherit=True)
+        except (SyntaxError, ValueError):
+            return False
+    return True
+
+
+def fix_file_whitespace(file_path, break_links=False):
+    """Fix whitespace issues in a single file.
+
+    Returns UNCHANGED, FIXED or FAILED.  The file is only rewritten when
+    the fixed content differs from the original.  Symlinks are followed
+    and hard linked files are rewritten in place, unless break_links is
+    set, in which case the file is replaced by a new (unlinked) copy.
+    """
     if not os.path.exists(file_path):
-        return False
+        return FAILED
     
-    print(f"Processing {file_path}")
+    is_python = file_path.endswith('.py')
     
+    # Stream the fixed content into a temporary file next to the real
+    # file and then move it over the original, so the file is never left
+    # half written.  Lines are handled as raw bytes and only decoded to
+    # validate them (and to break long Python lines).
+    real_path = os.path.realpath(file_path)
+    tmp_path = None
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        with open(real_path, 'rb') as src:
+            # Leave clean files (and their mtime) alone without writing
+            # anything
+            if is_clean(src, is_python):
+                return UNCHANGED
+            src.seek(0)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(real_path),
+                prefix='.' + os.path.basename(real_path) + '.',
+                suffix='.tmp')
+            with os.fdopen(fd, 'wb', buffering=1 << 16) as dst:
+                write_lines(dst, fix_lines(src, is_python))
+        # Never let a line break turn valid Python into a syntax error
+        if (is_python and not compiles(tmp_path)
+                and compiles(real_path)):
+            print(f"Error: fixing {file_path} would break its syntax, "
+                  "skipping")
+            return FAILED
+        if os.stat(real_path).st_nlink > 1 and not break_links:
+            # Write through so every hard link sees the fixed content
+            shutil.copyfile(tmp_path, real_path)
+        else:
+            shutil.copymode(real_path, tmp_path)
+            os.replace(tmp_path, real_path)
+            tmp_path = None
+        return FIXED
     except UnicodeDecodeError:
         print(f"Warning: Could not read {file_path} as UTF-8, skipping")
-        return False
-    
-    fixed_lines = []
-    is_python = file_path.endswith('.py')
-    is_c = file_path.endswith('.c') or file_path.endswith('.h')
-    
-    for line_num, line in enumerate(lines, 1):
-        # Remove newline for processing
-        line = line.rstrip('\n\r')
-        
-        if is_python:
-            fixed_line = fix_python_line(line, line_num)
-        elif is_c:
-            fixed_line = fix_c_line(line, line_num)
-        else:
-            # For other files, just remove trailing whitespace
-            fixed_line = line.rstrip()
-        
-        # Handle multi-line results
-        if '\n' in fixed_line:
-            fixed_lines.extend(fixed_line.split('\n'))
-        else:
-            fixed_lines.append(fixed_line)
-    
-    # Remove trailing empty lines
-    while fixed_lines and fixed_lines[-1] == '':
-        fixed_lines.pop()
-    
-    # Add exactly one newline at the end
-    if fixed_lines:
-        fixed_lines.append('')
-    
-    # Write the fixed content
-    try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write('\n'.join(fixed_lines))
-        return True
+        return FAILED
     except Exception as e:
         print(f"Error writing {file_path}: {e}")
-        return False
+        return FAILED
+    finally:
+        # Only ever remove the temporary file created above
+        if tmp_path is not None:
+            os.remove(tmp_path)
+
+
+def fix_files(file_paths, jobs, break_links=False):
+    """Fix each file, yielding the statuses in order.
+
+    Files are spread over up to jobs worker processes when there is more
+    than one job and more than one file.
+    """
+    fix_file = functools.partial(fix_file_whitespace,
+                                 break_links=break_links)
+    if jobs <= 1 or len(file_paths) <= 1:
+        yield from map(fix_file, file_paths)
+        return
+    # Only parallel runs pay for importing concurrent.futures
+    from concurrent.futures import ProcessPoolExecutor
+    jobs = min(jobs, len(file_paths))
+    chunksize = max(1, len(file_paths) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(fix_file, file_paths, chunksize=chunksize)
 
 
 def main():
@@ -264,24 +438,38 @@ def main():
         action='store_true',
         help='Verbose output'
     )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Number of files to fix in parallel (default: CPU count)'
+    )
+    parser.add_argument(
+        '--break-links',
+        action='store_true',
+        help='Replace hard linked files with a fixed copy instead of '
+             'rewriting them in place'
+    )
     
     args = parser.parse_args()
     
-    success_count = 0
+    counts = {UNCHANGED: 0, FIXED: 0, FAILED: 0}
     total_count = len(args.files)
     
-    for file_path in args.files:
-        if fix_file_whitespace(file_path):
-            success_count += 1
-            if args.verbose:
+    statuses = fix_files(args.files, args.jobs, args.break_links)
+    for file_path, status in zip(args.files, statuses):
+        counts[status] += 1
+        if args.verbose:
+            if status == FIXED:
                 print(f"✓ Fixed {file_path}")
-        else:
-            if args.verbose:
+            elif status == UNCHANGED:
+                print(f"✓ No changes needed in {file_path}")
+            else:
                 print(f"✗ Failed to fix {file_path}")
     
-    print(f"Fixed {success_count}/{total_count} files")
-    return 0 if success_count == total_count else 1
-
+    print(f"Fixed {counts[FIXED]}/{total_count} files "
+          f"({counts[UNCHANGED]} unchanged, {counts[FAILED]} failed)")
+    return 0 if counts[FAILED] == 0 else 1
 
 if __name__ == "__main__":
     sys.exit(main()) 
\ No newline at end of file
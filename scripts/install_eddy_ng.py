@@ -7,10 +7,6 @@ import shutil
 import subprocess
 from pathlib import Path
 
-IS_MAC = os.path.isdir("/System/Library")
-
-SED_IN_PLACE_ARG = "-i ''" if IS_MAC else "-i"
-
 # Files to copy for repo installation (relative to eddy-ng submodule)
 FILES_TO_COPY = {
     "probe_eddy_ng.py": "klippy/extras",
@@ -23,6 +19,31 @@ def get_script_dir():
     return os.path.dirname(os.path.realpath(__file__))
 
 
+def has_entries(directory, names):
+    """Check that all names exist directly inside directory"""
+    try:
+        with os.scandir(directory) as it:
+            entries = {entry.name for entry in it}
+    except OSError:
+        return False
+    return all(name in entries for name in names)
+
+
+def list_dir(dir_cache, directory):
+    """Return the set of entry names in directory (None if unreadable)
+
+    Listings are cached in dir_cache so each directory is only read
+    once; callers must update the cached set when they add or remove
+    files.
+    """
+    if directory not in dir_cache:
+        try:
+            dir_cache[directory] = set(os.listdir(directory))
+        except OSError:
+            dir_cache[directory] = None
+    return dir_cache[directory]
+
+
 def get_repo_root():
     """Find the repository root by looking for key Klipper files"""
     script_dir = get_script_dir()
@@ -33,13 +54,11 @@ def get_repo_root():
     # Look for key Klipper files to confirm we're in the right place
     klipper_markers = ["klippy", "src", "Makefile", "README.md"]
 
-    if all(os.path.exists(os.path.join(potential_root, marker))
-           for marker in klipper_markers):
+    if has_entries(potential_root, klipper_markers):
         return potential_root
 
     # Fallback: check current directory
-    if all(os.path.exists(os.path.join(script_dir, marker))
-           for marker in klipper_markers):
+    if has_entries(script_dir, klipper_markers):
         return script_dir
 
     return None
@@ -60,8 +79,9 @@ def fix_whitespace_issues(file_path):
         return False
     
     try:
+        # Files may be hard linked to the submodule; never modify it
         result = subprocess.run([
-            sys.executable, fixer_path, file_path
+            sys.executable, fixer_path, "--break-links", file_path
         ], capture_output=True, text=True)
         
         if result.returncode == 0:
@@ -76,17 +96,55 @@ def fix_whitespace_issues(file_path):
         return False
 
 
+def link_or_copy(src_path, dest_file, copy=False):
+    """Hard link src_path to dest_file, copying it if linking fails
+
+    Returns True if a hard link was created.
+    """
+    if not copy:
+        try:
+            os.link(src_path, dest_file)
+            return True
+        except OSError:
+            # Eg, a different filesystem or no hard link support
+            pass
+    shutil.copyfile(src_path, dest_file)
+    return False
+
+
+def patch_file(file_path, old, new, marker=None):
+    """Replace all occurrences of old with new in a file
+
+    The file is read once and only written if its content changes.
+    Returns True if the file was patched, None if it already contains
+    marker, and False if old was not found.
+    """
+    path = Path(file_path)
+    content = path.read_text()
+    if marker is not None and marker in content:
+        return None
+    patched = content.replace(old, new)
+    if patched == content:
+        return False
+    path.write_text(patched)
+    return True
+
+
 def uninstall_repo(target_dir: str):
     """Remove eddy-ng files from the repository"""
     print("Uninstalling eddy-ng from repository...")
 
     # Remove copied files
+    dir_cache = {}
     for src_file, dest_dir in FILES_TO_COPY.items():
         dest_path = os.path.join(target_dir, dest_dir)
-        dest_file = os.path.join(dest_path, os.path.basename(src_file))
-        if os.path.isfile(dest_file):
+        file_name = os.path.basename(src_file)
+        dest_file = os.path.join(dest_path, file_name)
+        dest_entries = list_dir(dir_cache, dest_path)
+        if dest_entries is not None and file_name in dest_entries:
             print(f"Removing {dest_file}")
             os.remove(dest_file)
+            dest_entries.discard(file_name)
         else:
             print(f"File {dest_file} does not exist. Skipping.")
 
@@ -94,21 +152,20 @@ def uninstall_repo(target_dir: str):
     print("Unpatching src/Makefile...")
     makefile_path = os.path.join(target_dir, "src/Makefile")
     if os.path.exists(makefile_path):
-        os.system(f"sed {SED_IN_PLACE_ARG} 's, sensor_ldc1612_ng.c,,' "
-                  f"'{makefile_path}'")
+        patch_file(makefile_path, " sensor_ldc1612_ng.c", "")
 
     # Unpatch klippy/extras/bed_mesh.py
     print("Unpatching klippy/extras/bed_mesh.py...")
     bed_mesh_path = os.path.join(target_dir, "klippy/extras/bed_mesh.py")
     if os.path.exists(bed_mesh_path):
-        pattern = ('s,\"eddy\" in probe_name #eddy-ng,'
-                   'probe_name.startswith(\"probe_eddy_current\"),')
-        os.system(f"sed {SED_IN_PLACE_ARG} '{pattern}' '{bed_mesh_path}'")
+        patch_file(bed_mesh_path, '"eddy" in probe_name #eddy-ng',
+                   'probe_name.startswith("probe_eddy_current")')
 
     print("eddy-ng uninstalled from repository.")
 
 
-def install_repo(target_dir: str, uninstall: bool = False):
+def install_repo(target_dir: str, uninstall: bool = False,
+                 copy: bool = False):
     """Install eddy-ng files into the repository"""
 
     if uninstall:
@@ -127,43 +184,50 @@ def install_repo(target_dir: str, uninstall: bool = False):
         sys.exit(1)
 
     # Copy files to their destinations
+    dir_cache = {}
     for src_file, dest_dir in FILES_TO_COPY.items():
         src_path = os.path.join(eddy_ng_path, src_file)
         dest_path = os.path.join(target_dir, dest_dir)
-        dest_file = os.path.join(dest_path, os.path.basename(src_file))
+        file_name = os.path.basename(src_file)
+        dest_file = os.path.join(dest_path, file_name)
 
-        if not os.path.exists(src_path):
+        src_entries = list_dir(dir_cache, os.path.dirname(src_path))
+        if src_entries is None or file_name not in src_entries:
             print(f"Warning: Source file {src_path} does not exist. "
                   "Skipping.")
             continue
 
-        if not os.path.exists(dest_path):
+        dest_entries = list_dir(dir_cache, dest_path)
+        if dest_entries is None:
             print(f"Warning: Destination directory {dest_path} does not "
                   "exist. Skipping.")
             continue
 
-        print(f"Copying {src_file} to {dest_dir}/")
-        shutil.copyfile(src_path, dest_file)
+        # Replace any previous install (which may be a link to src_path)
+        if file_name in dest_entries:
+            os.remove(dest_file)
+        if link_or_copy(src_path, dest_file, copy):
+            print(f"Linked {src_file} to {dest_dir}/")
+        else:
+            print(f"Copied {src_file} to {dest_dir}/")
+        dest_entries.add(file_name)
 
-        # Fix whitespace issues in the copied file
+        # Fix whitespace issues in the installed file
         fix_whitespace_issues(dest_file)
 
     # Patch src/Makefile
     print("Patching src/Makefile...")
     makefile_path = os.path.join(target_dir, "src/Makefile")
     if os.path.exists(makefile_path):
-        # Check if already patched
-        with open(makefile_path, 'r') as f:
-            content = f.read()
-
-        if "sensor_ldc1612_ng.c" not in content:
-            pattern = ('s,sensor_ldc1612.c$,'
-                       'sensor_ldc1612.c sensor_ldc1612_ng.c,')
-            os.system(f"sed {SED_IN_PLACE_ARG} '{pattern}' "
-                      f"'{makefile_path}'")
+        patched = patch_file(makefile_path, "sensor_ldc1612.c\n",
+                             "sensor_ldc1612.c sensor_ldc1612_ng.c\n",
+                             marker="sensor_ldc1612_ng.c")
+        if patched:
             print("Makefile patched successfully.")
-        else:
+        elif patched is None:
             print("Makefile already patched.")
+        else:
+            print("Warning: sensor_ldc1612.c not found in src/Makefile.")
     else:
         print("Warning: src/Makefile not found.")
 
@@ -171,25 +235,23 @@ def install_repo(target_dir: str, uninstall: bool = False):
     print("Patching klippy/extras/bed_mesh.py...")
     bed_mesh_path = os.path.join(target_dir, "klippy/extras/bed_mesh.py")
     if os.path.exists(bed_mesh_path):
-        # Check if already patched
-        with open(bed_mesh_path, 'r') as f:
-            content = f.read()
-
-        if "#eddy-ng" not in content:
-            pattern = ('s,probe_name.startswith(\"probe_eddy_current\"),'
-                       '\"eddy\" in probe_name #eddy-ng,')
-            os.system(f"sed {SED_IN_PLACE_ARG} '{pattern}' "
-                      f"'{bed_mesh_path}'")
+        patched = patch_file(bed_mesh_path,
+                             'probe_name.startswith("probe_eddy_current")',
+                             '"eddy" in probe_name #eddy-ng',
+                             marker="#eddy-ng")
+        if patched:
             print("bed_mesh.py patched successfully.")
-        else:
+        elif patched is None:
             print("bed_mesh.py already patched.")
+        else:
+            print("Warning: probe detection not found in bed_mesh.py.")
     else:
         print("Warning: klippy/extras/bed_mesh.py not found.")
 
     print("")
     print("Installation complete!")
     print("======================")
-    print("Files have been copied into the repository.")
+    print("Files have been installed into the repository.")
     print("Whitespace issues have been automatically fixed.")
     print("When building firmware, make sure to enable "
           "CONFIG_WANT_LDC1612=y")
@@ -206,6 +268,11 @@ def main():
         action="store_true",
         help="Uninstall eddy-ng from repository"
     )
+    parser.add_argument(
+        "-c", "--copy",
+        action="store_true",
+        help="Always copy files instead of hard linking them"
+    )
     parser.add_argument(
         "target_dir",
         nargs="?",
@@ -244,7 +311,7 @@ def main():
         sys.exit(1)
 
     # Run installation
-    install_repo(target_dir, uninstall)
+    install_repo(target_dir, uninstall, args.copy)
 
 
 if __name__ == "__main__":